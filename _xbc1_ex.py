@@ -1,15 +1,198 @@
 import os
 import struct
-import zlib
+import sys
+import numpy as np
+import xxhash
 import zstandard as zstd
 from enum import IntEnum
 import concurrent.futures
+import collections
+import contextlib
+import functools
+import io
+import logging
+import logging.handlers
+import mmap
+import multiprocessing
+import shutil
+import tarfile
+import threading
 from tqdm import tqdm
 
+# zlib-ng is a drop-in replacement for zlib that compresses several times faster
+# with the same stream format, so it is used when installed (pip install zlib-ng)
+try:
+    from zlib_ng import zlib_ng as zlib
+except ImportError:
+    import zlib
+
+# Per-file details and warnings go through logging, so they can be silenced or enabled (-v) as a whole
+log = logging.getLogger("xbc1")
+
 class CompType(IntEnum):
     ZLIB = 1
     ZSTD = 3
 
+# Precompiled binary layouts
+# XBC1 header (48 bytes): magic, compression type, uncompressed size, compressed size, hash, name (28 bytes)
+XBC1_HEADER = struct.Struct("<4sIIII28s")
+# ARH header (16 bytes): magic, number of entries, offset to entries, padding (or offset to the zstd dictionary)
+ARH_HEADER = struct.Struct("<4sIII")
+# ARH entry (16 bytes): cache_id, size, uncompressed size (read and written as whole numpy arrays)
+ARH_ENTRY_DTYPE = np.dtype([('cache_id', '<u8'), ('size', '<u4'), ('uncompressed_size', '<u4')])
+# Header of the optional zstd dictionary stored after the ARH entries: tag, dictionary size
+ARH_DICT_HEADER = struct.Struct("<4sI")
+ARH_DICT_TAG = b'zdic'
+
+# File magic numbers as little-endian 32-bit integers, so they can be checked without slicing the data
+MAGIC = struct.Struct("<I")
+XBC1_MAGIC = MAGIC.unpack(b'xbc1')[0]
+BDAT_MAGIC = MAGIC.unpack(b'BDAT')[0]
+
+# Zero bytes used to pad files in the ARD to 16 bytes
+ARD_PADDING = bytes(16)
+
+# Default compression levels. The maximum levels (9 for zlib, 22 for zstd) are several times
+# slower for less than 1% smaller output, so they are only used when explicitly requested
+DEFAULT_ZLIB_LEVEL = 6
+DEFAULT_ZSTD_LEVEL = 19
+# zstd level used when creating ARD archives, where many files are compressed
+DEFAULT_ARD_ZSTD_LEVEL = 15
+# Smaller files are compressed by a single zstd thread when creating ARD archives:
+# they are not large enough to be split into several zstd jobs
+ZSTD_MT_MIN_SIZE = 4 * 1024 * 1024
+
+# Size of the zstd dictionary trained for small files, and the largest file used to train it
+ZSTD_DICT_SIZE = 112 * 1024
+ZSTD_DICT_MAX_SAMPLE_SIZE = 64 * 1024
+
+# zstd contexts are not safe for concurrent use, so each thread keeps its own
+_thread_local = threading.local()
+
+def get_zstd_decompressor() -> zstd.ZstdDecompressor:
+    """Returns the ZstdDecompressor of the current thread (created on first use)"""
+    dctx = getattr(_thread_local, 'zstd_dctx', None)
+    if dctx is None:
+        dctx = _thread_local.zstd_dctx = zstd.ZstdDecompressor()
+    return dctx
+
+def get_zstd_compressor(level: int = DEFAULT_ZSTD_LEVEL, threads: int = 0) -> zstd.ZstdCompressor:
+    """
+    Returns the ZstdCompressor of the current thread for the given settings (created on first use)
+    
+    Args:
+        level: compression level
+        threads: number of zstd worker threads (0 = single-threaded, -1 = one per CPU core)
+    """
+    compressors = getattr(_thread_local, 'zstd_cctx', None)
+    if compressors is None:
+        compressors = _thread_local.zstd_cctx = {}
+    cctx = compressors.get((level, threads))
+    if cctx is None:
+        cctx = compressors[(level, threads)] = zstd.ZstdCompressor(level=level, threads=threads)
+    return cctx
+
+def calculate_xbc1_hash(data: bytes) -> int:
+    """Calculates the simple hash written to the XBC1 header (sum of all bytes, truncated to 32 bits)"""
+    # Summed in NumPy instead of iterating over the bytes in Python; a 32-bit accumulator
+    # wraps around exactly like the truncation, and vectorizes twice as wide as a 64-bit one
+    return int(np.frombuffer(data, dtype=np.uint8).sum(dtype=np.uint32))
+
+def parse_xbc1_header(data: bytes) -> tuple:
+    """
+    Parses the 48-byte header of XBC1 data
+    
+    Args:
+        data: data starting with the XBC1 header
+    
+    Returns:
+        tuple: (compression_type, uncompressed_size, compressed_size, name)
+    """
+    _, compression_type, uncompressed_size, compressed_size, _, name_bytes = XBC1_HEADER.unpack_from(data)
+    name = name_bytes.partition(b'\x00')[0].decode('ascii', errors='ignore')
+    return compression_type, uncompressed_size, compressed_size, name
+
+def build_xbc1_header(compression_type: int, data: bytes, compressed_size: int, name: str) -> bytes:
+    """
+    Builds the 48-byte header of an XBC1 file
+    
+    Args:
+        compression_type: compression type (ZLIB or ZSTD)
+        data: uncompressed data (used for the size and the hash)
+        compressed_size: size of the compressed data
+        name: file name to write in the header (truncated to 27 characters)
+    
+    Returns:
+        bytes: XBC1 header
+    """
+    # Leave space for the null terminator, the rest of the name field is padded with zeros
+    name_bytes = name[:27].encode('ascii', errors='ignore')
+    return XBC1_HEADER.pack(b'xbc1', compression_type, len(data), compressed_size, calculate_xbc1_hash(data), name_bytes)
+
+# Python's zlib has no inflateReset/deflateReset, and Decompress.copy()/Compress.copy()
+# are slower than creating a new stream, so zlib stays on the one-shot C functions
+def decompress_payload(compression_type: int, compressed_data: bytes, uncompressed_size: int = 0,
+                       dctx: zstd.ZstdDecompressor = None) -> bytes:
+    """
+    Decompresses the payload of an XBC1 file (the data after the 48-byte header)
+    
+    Args:
+        compression_type: compression type from the XBC1 header
+        compressed_data: compressed data without the header
+        uncompressed_size: uncompressed size from the XBC1 header, used to allocate
+            the output buffer once instead of growing it (0 if unknown)
+        dctx: ZstdDecompressor to use instead of the default one (e.g. one with a dictionary)
+    
+    Returns:
+        bytes: decompressed data
+    """
+    if compression_type == CompType.ZLIB:
+        try:
+            return zlib.decompress(compressed_data, zlib.MAX_WBITS, uncompressed_size or zlib.DEF_BUF_SIZE)
+        except zlib.error as e:
+            raise ValueError(f"ZLIB decompression error: {e}")
+    
+    elif compression_type == CompType.ZSTD:
+        try:
+            if dctx is None:
+                dctx = get_zstd_decompressor()
+            return dctx.decompress(compressed_data, max_output_size=uncompressed_size)
+        except zstd.ZstdError as e:
+            raise ValueError(f"ZSTD decompression error: {e}")
+    
+    raise ValueError(f"Unknown compression type: {compression_type}")
+
+def compress_payload(compression_type: int, data: bytes, level: int = None, threads: int = 0,
+                     cctx: zstd.ZstdCompressor = None) -> bytes:
+    """
+    Compresses data for the payload of an XBC1 file
+    
+    Args:
+        compression_type: compression type (ZLIB or ZSTD)
+        data: data to compress
+        level: compression level (if None, the default level for the compression type is used)
+        threads: number of zstd worker threads (0 = single-threaded, -1 = one per CPU core)
+        cctx: ZstdCompressor to use instead of the default one (e.g. one with a dictionary)
+    
+    Returns:
+        bytes: compressed data without the header
+    """
+    if compression_type == CompType.ZLIB:
+        try:
+            return zlib.compress(data, level=DEFAULT_ZLIB_LEVEL if level is None else level)
+        except zlib.error as e:
+            raise ValueError(f"ZLIB compression error: {e}")
+    
+    elif compression_type == CompType.ZSTD:
+        try:
+            if cctx is None:
+                cctx = get_zstd_compressor(DEFAULT_ZSTD_LEVEL if level is None else level, threads)
+            return cctx.compress(data)
+        except zstd.ZstdError as e:
+            raise ValueError(f"ZSTD compression error: {e}")
+    
+    raise ValueError(f"Unknown compression type: {compression_type}")
+
 def decompress_xbc1_file(input_file: str, output_file: str = None) -> None:
     """
     Decompresses an XBC1 file
@@ -28,36 +211,18 @@ def decompress_xbc1_file(input_file: str, output_file: str = None) -> None:
         raise ValueError(f"Not an XBC1 file! Magic number: {data[:4]}")
     
     # Read the header
-    compression_type = struct.unpack("<I", data[4:8])[0]
-    uncompressed_size = struct.unpack("<I", data[8:12])[0]
-    compressed_size = struct.unpack("<I", data[12:16])[0]
-    # hash = struct.unpack("<I", data[16:20])[0]  # not used
-    name = data[20:48].split(b'\x00')[0].decode('ascii', errors='ignore')
+    compression_type, uncompressed_size, compressed_size, name = parse_xbc1_header(data)
     
-    print(f"Compression type: {compression_type}")
-    print(f"Size before decompression: {compressed_size}")
-    print(f"Size after decompression: {uncompressed_size}")
-    print(f"File name in header: {name}")
+    log.info("Compression type: %d", compression_type)
+    log.info("Size before decompression: %d", compressed_size)
+    log.info("Size after decompression: %d", uncompressed_size)
+    log.info("File name in header: %s", name)
     
     # Get the compressed data after the header (48 bytes)
     compressed_data = data[48:48 + compressed_size]
     
     # Decompress
-    if compression_type == CompType.ZLIB:
-        try:
-            decompressed = zlib.decompress(compressed_data)
-        except zlib.error as e:
-            raise ValueError(f"ZLIB decompression error: {e}")
-    
-    elif compression_type == CompType.ZSTD:
-        try:
-            dctx = zstd.ZstdDecompressor()
-            decompressed = dctx.decompress(compressed_data)
-        except zstd.ZstdError as e:
-            raise ValueError(f"ZSTD decompression error: {e}")
-    
-    else:
-        raise ValueError(f"Unknown compression type: {compression_type}")
+    decompressed = decompress_payload(compression_type, compressed_data, uncompressed_size)
     
     # Check the size
     if len(decompressed) != uncompressed_size:
@@ -74,7 +239,36 @@ def decompress_xbc1_file(input_file: str, output_file: str = None) -> None:
     
     print(f"Decompressed to: {output_file}")
 
-def compress_xbc1_file(input_file: str, output_file: str = None, compression_type: CompType = CompType.ZLIB, name: str = "") -> None:
+# Compressed payloads of small files already compressed by this process, keyed by content hash and settings.
+# Game data contains many identical small files (placeholders, empty files), which then only need compressing once
+DEDUP_MAX_FILE_SIZE = 64 * 1024
+DEDUP_MAX_ENTRIES = 1024
+_compressed_payloads = collections.OrderedDict()
+
+def compress_payload_dedup(compression_type: int, data: bytes, level: int = None, threads: int = 0,
+                           cctx: zstd.ZstdCompressor = None) -> bytes:
+    """
+    Same as compress_payload, but reuses the result for small data with the same content
+    that was already compressed with the same settings
+    """
+    if len(data) > DEDUP_MAX_FILE_SIZE:
+        return compress_payload(compression_type, data, level, threads, cctx)
+    
+    key = (xxhash.xxh3_128_digest(data), compression_type, level, cctx)
+    compressed = _compressed_payloads.get(key)
+    if compressed is not None:
+        _compressed_payloads.move_to_end(key)
+        return compressed
+    
+    # Least recently used results are evicted, so duplicates are still found after many unique files
+    compressed = compress_payload(compression_type, data, level, threads, cctx)
+    _compressed_payloads[key] = compressed
+    if len(_compressed_payloads) > DEDUP_MAX_ENTRIES:
+        _compressed_payloads.popitem(last=False)
+    return compressed
+
+def compress_xbc1_file(input_file: str, output_file: str = None, compression_type: CompType = CompType.ZLIB, name: str = "",
+                       compression_level: int = None) -> None:
     """
     Compresses a file into XBC1 format
     
@@ -83,28 +277,15 @@ def compress_xbc1_file(input_file: str, output_file: str = None, compression_typ
         output_file: path to save the compressed file (if None, it is generated automatically)
         compression_type: compression type (ZLIB or ZSTD)
         name: file name to write in the header (maximum 27 characters)
+        compression_level: compression level (if None, 6 for ZLIB and 19 for ZSTD)
     """
     
     # Read the source file
     with open(input_file, 'rb') as f:
         data = f.read()
     
-    # Compress the data
-    if compression_type == CompType.ZLIB:
-        try:
-            compressed = zlib.compress(data, level=9)  # maximum compression
-        except zlib.error as e:
-            raise ValueError(f"ZLIB compression error: {e}")
-    
-    elif compression_type == CompType.ZSTD:
-        try:
-            cctx = zstd.ZstdCompressor(level=22)  # maximum compression
-            compressed = cctx.compress(data)
-        except zstd.ZstdError as e:
-            raise ValueError(f"ZSTD compression error: {e}")
-    
-    else:
-        raise ValueError(f"Unknown compression type: {compression_type}")
+    # Compress the data (a single file, so zstd may use all CPU cores)
+    compressed = compress_payload(compression_type, data, compression_level, threads=-1)
 
     # If the name is not specified, use the input file name
     if not name:
@@ -115,20 +296,7 @@ def compress_xbc1_file(input_file: str, output_file: str = None, compression_typ
         name = name[:27]
     
     # Create the header
-    header = bytearray()
-    header.extend(b'xbc1')  # magic number
-    header.extend(struct.pack("<I", compression_type))  # compression type
-    header.extend(struct.pack("<I", len(data)))  # uncompressed size
-    header.extend(struct.pack("<I", len(compressed)))  # compressed size
-    
-    # Calculate a simple hash (can be modified if a specific algorithm is needed)
-    simple_hash = sum(data) & 0xFFFFFFFF
-    header.extend(struct.pack("<I", simple_hash))  # hash
-    
-    # Add the file name (28 bytes including the null terminator)
-    name_bytes = name.encode('ascii', errors='ignore')
-    header.extend(name_bytes)
-    header.extend(b'\x00' * (28 - len(name_bytes)))  # pad with zeros
+    header = build_xbc1_header(compression_type, data, len(compressed), name)
     
     # Determine the output file name if not specified
     if output_file is None:
@@ -142,47 +310,261 @@ def compress_xbc1_file(input_file: str, output_file: str = None, compression_typ
     
     compression_ratio = (1 - len(compressed) / len(data)) * 100
     
-    print(f"Compression type: {compression_type}")
-    print(f"Original size: {len(data)}")
-    print(f"Size after compression: {len(compressed)}")
-    print(f"Compression ratio: {compression_ratio:.1f}%")
-    print(f"Name in header: {name}")
+    log.info("Compression type: %d", compression_type)
+    log.info("Original size: %d", len(data))
+    log.info("Size after compression: %d", len(compressed))
+    log.info("Compression ratio: %.1f%%", compression_ratio)
+    log.info("Name in header: %s", name)
     print(f"Compressed to: {output_file}")
 
-def read_arh_entries(arh_file: str) -> list:
+def read_arh_entries(arh_file: str) -> np.ndarray:
     """
     Reads entries from an ARH file
     
     Returns:
-        list of tuples: [(cache_id, size, uncompressed_size), ...]
+        np.ndarray: structured array with the fields cache_id, size and uncompressed_size
+            (entries.tolist() gives [(cache_id, size, uncompressed_size), ...])
     """
-    entries = []
     with open(arh_file, 'rb') as f:
         # Read the header
-        magic = f.read(4)
-        if magic != b'arh2':
-            raise ValueError(f"Invalid ARH file header: {magic}")
+        header_data = f.read(ARH_HEADER.size)
+        if header_data[:4] != b'arh2' or len(header_data) != ARH_HEADER.size:
+            raise ValueError(f"Invalid ARH file header: {header_data[:4]}")
+        
+        _, num_entries, entries_offset, _ = ARH_HEADER.unpack(header_data)
         
-        num_entries = struct.unpack("<I", f.read(4))[0]
-        entries_offset = struct.unpack("<I", f.read(4))[0]
+        # Map the file instead of reading the entries into an intermediate buffer
+        # (the mapping stays alive as long as the returned array references it)
+        arh_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    if entries_offset + num_entries * ARH_ENTRY_DTYPE.itemsize > len(arh_map):
+        raise ValueError(f"ARH file is truncated: expected {num_entries} entries")
+    
+    # View all entries in place as a structured array
+    # (8-byte cache_id, 4-byte size, 4-byte uncompressed size)
+    return np.frombuffer(arh_map, dtype=ARH_ENTRY_DTYPE, count=num_entries, offset=entries_offset)
+
+def read_arh_zstd_dictionary(arh_file: str) -> bytes:
+    """
+    Reads the zstd dictionary stored in an ARH file created with a dictionary
+    (the last header field holds its offset: the 'zdic' tag and a 4-byte size, followed by the dictionary data)
+    
+    Returns:
+        bytes: dictionary data, or None if the archive has no dictionary
+    """
+    with open(arh_file, 'rb') as f:
+        _, num_entries, entries_offset, dict_offset = ARH_HEADER.unpack(f.read(ARH_HEADER.size))
         
-        # Move to the entries
-        f.seek(entries_offset)
+        # Other tools leave this field as padding, so it is only a dictionary offset
+        # if it points past the entries to a tagged dictionary
+        if dict_offset < entries_offset + num_entries * ARH_ENTRY_DTYPE.itemsize:
+            return None
         
-        # Read all entries
-        for _ in range(num_entries):
-            cache_id = struct.unpack("<Q", f.read(8))[0]  # 8-byte cache_id
-            size = struct.unpack("<I", f.read(4))[0]      # 4-byte size
-            uncomp_size = struct.unpack("<I", f.read(4))[0]  # 4-byte uncompressed size
-            entries.append((cache_id, size, uncomp_size))
+        f.seek(dict_offset)
+        dict_header = f.read(ARH_DICT_HEADER.size)
+        if len(dict_header) != ARH_DICT_HEADER.size:
+            return None
+        tag, dict_size = ARH_DICT_HEADER.unpack(dict_header)
+        if tag != ARH_DICT_TAG:
+            return None
+        
+        dict_data = f.read(dict_size)
+        if len(dict_data) != dict_size:
+            log.warning("Warning: ARH file is truncated, ignoring its incomplete zstd dictionary")
+            return None
     
-    return entries
+    return dict_data
 
 def calculate_padding(offset: int, alignment: int = 16) -> int:
-    """Calculates the padding size for alignment"""
-    return (alignment - (offset % alignment)) % alignment
+    """Calculates the padding size for alignment (alignment must be a power of two)"""
+    return -offset & (alignment - 1)
+
+def calculate_ard_offsets(sizes: np.ndarray) -> np.ndarray:
+    """
+    Calculates the offsets of files stored one after another in an ARD file, each padded to 16 bytes
+    
+    Args:
+        sizes: sizes of the files
+    
+    Returns:
+        np.ndarray: offset of each file
+    """
+    padded_sizes = (sizes.astype(np.uint64) + 15) & ~np.uint64(15)
+    offsets = np.zeros(len(sizes), dtype=np.uint64)
+    np.cumsum(padded_sizes[:-1], out=offsets[1:])
+    return offsets
+
+def read_ard_magics(ard_file: str, offsets: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    """
+    Reads the magic number of every file in an ARD file at once
+    
+    Args:
+        ard_file: path to the .ard file
+        offsets: offsets of the files (see calculate_ard_offsets)
+        sizes: sizes of the files
+    
+    Returns:
+        np.ndarray: magic number of each file as a little-endian uint32 (0 if the file is shorter than 4 bytes)
+    """
+    magics = np.zeros(len(offsets), dtype=np.uint32)
+    with open(ard_file, 'rb') as f:
+        ard_size = os.fstat(f.fileno()).st_size
+        if not ard_size:
+            return magics
+        
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as ard_map:
+            # Gather the first 4 bytes of every file with one fancy-indexing operation
+            ard_bytes = np.frombuffer(ard_map, dtype=np.uint8)
+            valid = (sizes >= 4) & (offsets + 4 <= ard_size)
+            byte_indices = offsets[valid, None] + np.arange(4, dtype=np.uint64)
+            magics[valid] = ard_bytes[byte_indices].view('<u4').ravel()
+            # The array must be released before the mapping can be closed
+            del ard_bytes
+    
+    return magics
+
+def read_ard_entry(file_view: memoryview, cache_id: int, uncomp_size: int, dctx: zstd.ZstdDecompressor = None) -> tuple:
+    """
+    Reads one file from an ARD file, decompressing it if it's XBC1
+    
+    Args:
+        file_view: view of the file data in the memory-mapped ARD
+        cache_id: cache_id of the file (used in messages)
+        uncomp_size: uncompressed size from the ARH entry
+        dctx: ZstdDecompressor to use instead of the default one (e.g. one with the archive's dictionary)
+    
+    Returns:
+        tuple: (file_data, file_extension, is_bdat); file_data is file_view itself
+            if the file is stored uncompressed
+    """
+    # Determine the file type by its header
+    file_extension = ".dec"  # default extension
+    is_bdat = False
+    file_data = file_view
+    
+    # Read the magic number straight from the view (0 if the file is shorter than 4 bytes)
+    magic = MAGIC.unpack_from(file_view)[0] if len(file_view) >= 4 else 0
+    
+    # Decompress if it's XBC1, regardless of uncomp_size
+    if magic == XBC1_MAGIC:
+        try:
+            file_data = decompress_xbc1_file_data(file_view, dctx)
+            
+            # If uncomp_size is specified and doesn't match, print a warning
+            if uncomp_size > 0 and len(file_data) != uncomp_size:
+                log.warning("Warning: Decompressed file size mismatch %016x (expected: %d, got: %d)",
+                            cache_id, uncomp_size, len(file_data))
+            
+            # Check the header of the decompressed data
+            if file_data.startswith(b'BDAT'):
+                file_extension = ".bdat"
+                is_bdat = True
+            # Other file types can be added as needed
+                
+        except Exception as e:
+            log.error("Error decompressing file %016x: %s", cache_id, e)
+            # Save the original data if decompression fails
+            file_extension = ".failed"
+    elif uncomp_size > 0:
+        # If the file is marked as compressed but doesn't have an XBC1 header
+        log.warning("Warning: File %016x is marked as compressed (uncomp_size=%d), but is not XBC1", cache_id, uncomp_size)
+    else:
+        # Check the header of uncompressed data
+        if magic == BDAT_MAGIC:
+            file_extension = ".bdat"
+            is_bdat = True
+        # Other file types can be added as needed
+    
+    return file_data, file_extension, is_bdat
+
+@contextlib.contextmanager
+def worker_logging():
+    """
+    Collects the log records of worker processes in the main process while the context is active,
+    so they go through the main process handlers (worker processes may not inherit them)
+    and messages from several workers are not interleaved
+    
+    Returns:
+        tuple: (log_queue, log_level) to pass to init_worker_logging in the worker processes
+    """
+    log_queue = multiprocessing.Queue()
+    handlers = logging.getLogger().handlers or [logging.lastResort]
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    try:
+        yield log_queue, log.getEffectiveLevel()
+    finally:
+        listener.stop()
+
+def init_worker_logging(log_queue, log_level: int) -> None:
+    """Sends the log records of a worker process to the queue of worker_logging"""
+    log.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    log.setLevel(log_level)
+    log.propagate = False
+
+# Memory-mapped ARD file and dictionary decompressor (if the archive has a dictionary)
+# of the current extraction worker process
+_worker_ard_map = None
+_worker_zstd_dctx = None
+
+def init_extract_worker(ard_file: str, zstd_dict_data: bytes = None, log_queue=None, log_level: int = logging.WARNING) -> None:
+    """
+    Prepares an extraction worker process: maps the ARD file into memory (an empty file cannot be mapped),
+    creates the ZstdDecompressor for the archive's dictionary, if any, and sets up logging (see worker_logging)
+    """
+    global _worker_ard_map, _worker_zstd_dctx
+    if log_queue is not None:
+        init_worker_logging(log_queue, log_level)
+    with open(ard_file, 'rb') as f:
+        ard_size = os.fstat(f.fileno()).st_size
+        _worker_ard_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if ard_size else b''
+    if zstd_dict_data:
+        _worker_zstd_dctx = zstd.ZstdDecompressor(dict_data=zstd.ZstdCompressionDict(zstd_dict_data))
+
+def extract_ard_entry(entry: tuple, output_dir: str, only_bdat: bool = False, pack_output: bool = False) -> tuple:
+    """
+    Extracts one file from the ARD file mapped by init_extract_worker
+    (runs in a worker process of extract_ard_with_arh)
+    
+    Args:
+        entry: tuple (cache_id, size, uncomp_size, offset)
+        output_dir: directory to save the extracted file
+        only_bdat: if True, only saves BDAT files
+        pack_output: if True, the file is returned instead of saved (the main process packs it)
+    
+    Returns:
+        tuple: (file_name, file_data) if the file was extracted (file_data is None if it was already saved),
+            or None if it was skipped or failed
+    """
+    cache_id, size, uncomp_size, offset = entry
+    try:
+        # View the file in place: compressed data goes to the decompressor and uncompressed data
+        # goes to the output file straight from the mapping, without an intermediate copy
+        with memoryview(_worker_ard_map)[offset:offset + size] as file_view:
+            file_data, file_extension, is_bdat = read_ard_entry(file_view, cache_id, uncomp_size, _worker_zstd_dctx)
+            
+            # If only_bdat mode is enabled and it's not a BDAT file, skip saving
+            if only_bdat and not is_bdat:
+                return None
+            
+            # Form the output file name with the correct extension
+            file_name = f"{cache_id:016x}{file_extension}"
+            
+            if pack_output:
+                return file_name, bytes(file_data)
+            
+            # Save the file
+            with open(os.path.join(output_dir, file_name), 'wb') as out_f:
+                out_f.write(file_data)
+            
+            return file_name, None
+    
+    except Exception as e:
+        log.error("Error processing file %016x: %s", cache_id, e)
+        return None
 
-def extract_ard_with_arh(ard_file: str, arh_file: str, output_dir: str = None, only_bdat: bool = False) -> None:
+def extract_ard_with_arh(ard_file: str, arh_file: str, output_dir: str = None, only_bdat: bool = False,
+                         pack_output: bool = False) -> None:
     """
     Extracts an ARD file using information from an ARH file
     
@@ -191,269 +573,411 @@ def extract_ard_with_arh(ard_file: str, arh_file: str, output_dir: str = None, o
         arh_file: path to the .arh file
         output_dir: directory to save the extracted files
         only_bdat: if True, only saves BDAT files
+        pack_output: if True, saves the files into a single output_dir + ".tar" archive instead of a directory
     """
     
     # Determine the output directory
     if output_dir is None:
         output_dir = os.path.splitext(ard_file)[0] + "_extracted"
     
-    # Create the directory if it doesn't exist
-    os.makedirs(output_dir, exist_ok=True)
-    
     # Read entries from the ARH file
-    print("Reading ARH file...")
+    log.info("Reading ARH file...")
     entries = read_arh_entries(arh_file)
+    zstd_dict_data = read_arh_zstd_dictionary(arh_file)
     print(f"Found {len(entries)} files")
     
-    # Open the ARD file
-    with open(ard_file, 'rb') as f:
-        current_offset = 0
+    # Compute the offset of every file up front (files are stored one after another, each padded to 16 bytes)
+    offsets = calculate_ard_offsets(entries['size'])
+    work_entries = entries
+    if only_bdat:
+        # Only XBC1 files (which may contain BDAT) and BDAT files can be saved, so the other files
+        # are dropped here instead of being sent to the worker processes
+        # (except files marked as compressed, so the worker still warns that they are not XBC1)
+        magics = read_ard_magics(ard_file, offsets, entries['size'])
+        keep = (magics == XBC1_MAGIC) | (magics == BDAT_MAGIC) | (entries['uncompressed_size'] > 0)
+        work_entries, offsets = entries[keep], offsets[keep]
+    work = [(cache_id, size, uncomp_size, offset)
+            for (cache_id, size, uncomp_size), offset in zip(work_entries.tolist(), offsets.tolist())]
+    
+    with contextlib.ExitStack() as stack:
+        if pack_output:
+            # Write all files into one tar archive: a single output file instead of one
+            # create/write/close per extracted file
+            # (trailing separators are dropped, so "out/" gives "out.tar" rather than "out/.tar")
+            tar_file = os.path.normpath(output_dir)
+            if not tar_file.endswith(".tar"):
+                tar_file += ".tar"
+            tar = stack.enter_context(tarfile.open(tar_file, 'w'))
+            tar_mtime = os.path.getmtime(ard_file)
+        else:
+            # Create the directory if it doesn't exist
+            os.makedirs(output_dir, exist_ok=True)
+        
+        # Files are independent once their offsets are known, so they are extracted in parallel.
+        # Worker processes map the ARD themselves and only receive the entries, so no file data is
+        # sent to them; entries are submitted in windows (see map_in_windows) to bound the results
+        # waiting to be packed without letting the pool drain between windows.
+        # max_workers is left to the executor: it defaults to the CPU count, capped at 61 on Windows
+        log_queue, log_level = stack.enter_context(worker_logging())
+        executor = stack.enter_context(concurrent.futures.ProcessPoolExecutor(
+            initializer=init_extract_worker, initargs=(ard_file, zstd_dict_data, log_queue, log_level)))
+        extract_entry = functools.partial(extract_ard_entry, output_dir=output_dir, only_bdat=only_bdat,
+                                          pack_output=pack_output)
         saved_files = 0
         
-        for index, (cache_id, size, uncomp_size) in enumerate(entries, 1):
-            try:
-                # Move to the start of the file, considering padding
-                f.seek(current_offset)
-                
-                # Read the file data
-                file_data = f.read(size)
-                
-                # Determine the file type by its header
-                file_extension = ".dec"  # default extension
-                is_bdat = False
-                
-                # Check if the file is XBC1
-                is_xbc1 = file_data[:4] == b'xbc1'
-                
-                # Decompress if it's XBC1, regardless of uncomp_size
-                if is_xbc1:
-                    try:
-                        decompressed = decompress_xbc1_file_data(file_data)
-                        
-                        # If uncomp_size is specified and doesn't match, print a warning
-                        if uncomp_size > 0 and len(decompressed) != uncomp_size:
-                            print(f"Warning: Decompressed file size mismatch {cache_id:016x}")
-                            print(f"  Expected: {uncomp_size}, got: {len(decompressed)}")
-                        
-                        file_data = decompressed
-                        
-                        # Check the header of the decompressed data
-                        if len(file_data) >= 4:
-                            if file_data[:4] == b'BDAT':
-                                file_extension = ".bdat"
-                                is_bdat = True
-                            # Other file types can be added as needed
-                            
-                    except Exception as e:
-                        print(f"Error decompressing file {cache_id:016x}: {e}")
-                        # Save the original data if decompression fails
-                        file_extension = ".failed"
-                elif uncomp_size > 0:
-                    # If the file is marked as compressed but doesn't have an XBC1 header
-                    print(f"Warning: File {cache_id:016x} is marked as compressed (uncomp_size={uncomp_size}), but is not XBC1")
-                else:
-                    # Check the header of uncompressed data
-                    if len(file_data) >= 4:
-                        if file_data[:4] == b'BDAT':
-                            file_extension = ".bdat"
-                            is_bdat = True
-                        # Other file types can be added as needed
-                
-                # If only_bdat mode is enabled and it's not a BDAT file, skip saving
-                if only_bdat and not is_bdat:
-                    # Calculate the next offset, considering padding
-                    current_offset += size + calculate_padding(size)
-                    continue
-                
-                # Form the output file name with the correct extension
-                output_file = os.path.join(output_dir, f"{cache_id:016x}{file_extension}")
-                
-                # Save the file
-                with open(output_file, 'wb') as out_f:
-                    out_f.write(file_data)
-                
-                saved_files += 1
-                
-                # Calculate the next offset, considering padding
-                current_offset += size + calculate_padding(size)
-                
-                # Print progress
-                if index % 100 == 0 or index == len(entries):
-                    print(f"Processed files: {index}/{len(entries)}, saved: {saved_files}")
-                
-            except Exception as e:
-                print(f"Error processing file {cache_id:016x}: {e}")
-                # Calculate the next offset even if there's an error
-                current_offset += size + calculate_padding(size)
+        results = map_in_windows(executor, extract_entry, work, window_size=1024, chunksize=32)
+        for result in tqdm(results, total=len(work), desc="Extracting files"):
+            if result is None:
                 continue
-        
-        print("\nDone!")
-        print(f"Processed files: {len(entries)}")
-        print(f"Saved files: {saved_files}")
+            
+            file_name, file_data = result
+            if pack_output:
+                tar_info = tarfile.TarInfo(file_name)
+                tar_info.size = len(file_data)
+                tar_info.mtime = tar_mtime
+                tar.addfile(tar_info, io.BytesIO(file_data))
+            saved_files += 1
+    
+    print("\nDone!")
+    print(f"Processed files: {len(entries)}")
+    print(f"Saved files: {saved_files}")
+    if pack_output:
+        print(f"Packed into: {tar_file}")
 
-def decompress_xbc1_file_data(data: bytes) -> bytes:
+def decompress_xbc1_file_data(data: bytes, dctx: zstd.ZstdDecompressor = None) -> bytes:
     """
     Decompresses data in XBC1 format
     
     Args:
         data: compressed data with XBC1 header
+        dctx: ZstdDecompressor to use instead of the default one (e.g. one with a dictionary)
     
     Returns:
         bytes: decompressed data
     """
     # Read the header
-    compression_type = struct.unpack("<I", data[4:8])[0]
-    uncompressed_size = struct.unpack("<I", data[8:12])[0]
-    compressed_size = struct.unpack("<I", data[12:16])[0]
+    compression_type, uncompressed_size, compressed_size, _ = parse_xbc1_header(data)
     
     # Get the compressed data after the header (48 bytes)
     compressed_data = data[48:48 + compressed_size]
     
     # Decompress
-    if compression_type == CompType.ZLIB:
-        decompressed = zlib.decompress(compressed_data)
-    elif compression_type == CompType.ZSTD:
-        dctx = zstd.ZstdDecompressor()
-        decompressed = dctx.decompress(compressed_data)
-    else:
-        raise ValueError(f"Unknown compression type: {compression_type}")
+    return decompress_payload(compression_type, compressed_data, uncompressed_size, dctx)
+
+def iter_files(root: str):
+    """
+    Yields the paths of all files in a directory tree
+    (os.scandir reuses the file types read with the directory listing, so no extra stat calls are needed)
     
-    return decompressed
+    Args:
+        root: directory to scan
+    """
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry.path
 
-def create_ard_archive(input_dir: str, output_ard: str, output_arh: str, compress_files: bool = False) -> None:
+# Compressor with the trained zstd dictionary of the current archive creation worker process
+_worker_zstd_cctx = None
+
+def init_create_worker(zstd_dict_data: bytes = None, zstd_level: int = DEFAULT_ARD_ZSTD_LEVEL,
+                       log_queue=None, log_level: int = logging.WARNING) -> None:
     """
-    Creates a new ARD archive from files in a directory (optimized version)
+    Prepares an archive creation worker process: creates the ZstdCompressor for the trained dictionary (if any)
+    and sets up logging (see worker_logging)
+    """
+    global _worker_zstd_cctx
+    if log_queue is not None:
+        init_worker_logging(log_queue, log_level)
+    if zstd_dict_data:
+        _worker_zstd_cctx = zstd.ZstdCompressor(level=zstd_level, dict_data=zstd.ZstdCompressionDict(zstd_dict_data))
+
+def train_zstd_dictionary(files: list, dict_size: int = ZSTD_DICT_SIZE, max_samples: int = 1000,
+                          max_sample_size: int = ZSTD_DICT_MAX_SAMPLE_SIZE) -> bytes:
+    """
+    Trains a zstd dictionary on a sample of the small files to archive
     
     Args:
-        input_dir: directory with files to archive
-        output_ard: path to create the ARD file
-        output_arh: path to create the ARH file
-        compress_files: if True, compress files in XBC1 format
+        files: list of tuples (file_path, rel_path)
+        dict_size: maximum dictionary size in bytes
+        max_samples: maximum number of files to train on
+        max_sample_size: files larger than this are not used as samples
+    
+    Returns:
+        bytes: dictionary data, or None if the dictionary could not be trained
     """
-    # Get the list of all files in the directory
-    print("Scanning directory...")
-    files = []
-    for root, _, filenames in os.walk(input_dir):
-        for filename in filenames:
-            file_path = os.path.join(root, filename)
-            # Get the relative path
-            rel_path = os.path.relpath(file_path, input_dir)
-            files.append((file_path, rel_path))
+    # Spread the samples over the whole list rather than taking the files of the first directories
+    samples = []
+    step = max(1, len(files) // max_samples)
+    for file_path, _ in files[::step]:
+        if len(samples) >= max_samples:
+            break
+        try:
+            if os.path.getsize(file_path) > max_sample_size:
+                continue
+            with open(file_path, 'rb') as f:
+                sample = f.read()
+        except OSError:
+            continue
+        # Files that are already XBC1 are stored as is
+        if sample and not sample.startswith(b'xbc1'):
+            samples.append(sample)
     
-    total_files = len(files)
-    print(f"Found {total_files} files to archive")
+    try:
+        return zstd.train_dictionary(dict_size, samples).as_bytes()
+    except (zstd.ZstdError, ValueError) as e:
+        log.warning("Could not train a zstd dictionary (%s), compressing without it", e)
+        return None
+
+def get_ard_cache_id(file_path: str, rel_path: str) -> int:
+    """
+    Gets the cache_id of a file to add to an ARD archive: the file name if it is a hexadecimal
+    cache_id (as in extracted archives), otherwise a hash of the relative path
     
-    # Pre-process files (in parallel)
-    processed_files = []
+    Args:
+        file_path: path to the file
+        rel_path: path relative to the archived directory
     
-    def process_file(file_info):
-        file_path, rel_path = file_info
-        try:
-            # Read the file
+    Returns:
+        int: cache_id
+    """
+    # Generate cache_id from the file name
+    try:
+        base_name = os.path.basename(file_path).split('.')[0]
+        if base_name.isalnum() and len(base_name) <= 16:
+            return int(base_name, 16)
+    except ValueError:
+        pass
+    
+    # Otherwise hash the relative path (xxh64 rather than hash(), which is salted per process,
+    # so the same input directory always gives the same archive)
+    return xxhash.xxh64_intdigest(rel_path.replace(os.sep, '/').encode('utf-8', errors='surrogateescape'))
+
+def process_ard_file(file_info: tuple, compress_files: bool = False,
+                     zlib_level: int = DEFAULT_ZLIB_LEVEL, zstd_level: int = DEFAULT_ARD_ZSTD_LEVEL) -> tuple:
+    """
+    Prepares a file to add to an ARD archive, compressing it in XBC1 format if needed
+    (runs in a worker process of create_ard_archive)
+    
+    Args:
+        file_info: tuple (cache_id, file_path, rel_path)
+        compress_files: if True, compress the file in XBC1 format
+        zlib_level: compression level for files compressed with ZLIB
+        zstd_level: compression level for files compressed with ZSTD
+    
+    Returns:
+        tuple: (cache_id, file_path, file_parts, uncompressed_size), or None if the file could not be processed;
+            file_parts is None if the file is stored as is
+    """
+    cache_id, file_path, rel_path = file_info
+    try:
+        # Compress the file if needed
+        # (the file is kept as a tuple of parts, so the header and the compressed data are never concatenated;
+        # files stored as is are not even read here, the writer copies them from the disk straight into the ARD)
+        file_parts = None
+        uncompressed_size = 0
+        if compress_files:
             with open(file_path, 'rb') as f:
                 file_data = f.read()
             
-            # Generate cache_id from the file name
-            try:
-                base_name = os.path.basename(file_path).split('.')[0]
-                if base_name.isalnum() and len(base_name) <= 16:
-                    cache_id = int(base_name, 16)
-                else:
-                    cache_id = hash(rel_path) & 0xFFFFFFFFFFFFFFFF
-            except ValueError:
-                cache_id = hash(rel_path) & 0xFFFFFFFFFFFFFFFF
-            
-            # Compress the file if needed
-            uncompressed_size = 0
-            if compress_files and file_data[:4] != b'xbc1':
+            if not file_data.startswith(b'xbc1'):
                 # Determine the compression type based on file size
                 comp_type = CompType.ZSTD if len(file_data) > 1024*1024 else CompType.ZLIB
                 
-                # Compress the data
-                if comp_type == CompType.ZLIB:
-                    compressed = zlib.compress(file_data, level=9)
+                if comp_type == CompType.ZLIB and _worker_zstd_cctx is not None:
+                    # Small files share a lot of structure, so the trained dictionary compresses them
+                    # much better with ZSTD than ZLIB does on its own
+                    compressed = compress_payload_dedup(CompType.ZSTD, file_data, zstd_level, cctx=_worker_zstd_cctx)
+                    comp_type = CompType.ZSTD
                 else:
-                    cctx = zstd.ZstdCompressor(level=22)
-                    compressed = cctx.compress(file_data)
+                    # Compress the data (other files are compressed by the other worker processes,
+                    # so only very large zstd files get a couple of threads, enough that a few of them
+                    # at the end don't keep the archive waiting, without oversubscribing the CPU)
+                    level = zstd_level if comp_type == CompType.ZSTD else zlib_level
+                    threads = 2 if len(file_data) > ZSTD_MT_MIN_SIZE else 0
+                    compressed = compress_payload_dedup(comp_type, file_data, level, threads)
                 
-                # Create the XBC1 header
-                header = bytearray()
-                header.extend(b'xbc1')
-                header.extend(struct.pack("<I", comp_type))
-                header.extend(struct.pack("<I", len(file_data)))
-                header.extend(struct.pack("<I", len(compressed)))
+                # Create the XBC1 header with the file name
+                header = build_xbc1_header(comp_type, file_data, len(compressed), os.path.basename(rel_path))
                 
-                # Calculate the hash
-                simple_hash = sum(file_data) & 0xFFFFFFFF
-                header.extend(struct.pack("<I", simple_hash))
-                
-                # Add the file name
-                name = os.path.basename(rel_path)
-                if len(name) > 27:
-                    name = name[:27]
-                name_bytes = name.encode('ascii', errors='ignore')
-                header.extend(name_bytes)
-                header.extend(b'\x00' * (28 - len(name_bytes)))
-                
-                # Combine the header and compressed data
-                file_data = header + compressed
-                uncompressed_size = len(file_data)
-            
-            return (cache_id, file_data, uncompressed_size)
-        except Exception as e:
-            print(f"Error processing file {rel_path}: {e}")
-            return None
+                file_parts = (header, compressed)
+                uncompressed_size = len(header) + len(compressed)
+        
+        return (cache_id, file_path, file_parts, uncompressed_size)
+    except Exception as e:
+        log.error("Error processing file %s: %s", rel_path, e)
+        return None
+
+def map_in_windows(executor: concurrent.futures.Executor, fn, items: list, window_size: int = 1024,
+                   chunksize: int = 1):
+    """
+    Like executor.map, but submits the items in windows and keeps at most two windows in flight,
+    so the results can be consumed while the next window is processed without holding all of them in memory
     
-    # Use ThreadPoolExecutor for parallel file processing
-    print("Processing files...")
-    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
-        # Use tqdm to show progress
-        for result in tqdm(executor.map(process_file, files), total=total_files, desc="Processing files"):
-            if result:
-                processed_files.append(result)
+    Args:
+        executor: executor to run fn in
+        fn: function to call on each item
+        items: list of items
+        window_size: number of items submitted at once
+        chunksize: chunksize passed to executor.map
+    
+    Returns:
+        generator: results in the order of the items
+    """
+    in_flight = collections.deque()
+    for window_start in range(0, len(items), window_size):
+        in_flight.append(executor.map(fn, items[window_start:window_start + window_size], chunksize=chunksize))
+        if len(in_flight) > 1:
+            yield from in_flight.popleft()
+    while in_flight:
+        yield from in_flight.popleft()
+
+def copy_file_into(out_file, file_path: str) -> int:
+    """
+    Appends a file to an open output file, with os.sendfile on Linux
+    so the data is copied by the kernel without going through Python
+    
+    Args:
+        out_file: output file opened in binary write mode
+        file_path: path of the file to copy
+    
+    Returns:
+        int: number of bytes copied
     
-    # Sort files by cache_id for more efficient searching
-    processed_files.sort(key=lambda x: x[0])
+    Raises:
+        OSError: if the file could not be copied; part of it may already be written to out_file
+    """
+    with open(file_path, 'rb') as src:
+        # Like shutil, sendfile is only used on Linux: on macOS and the BSDs it can only write to sockets
+        if sys.platform.startswith('linux'):
+            file_size = os.fstat(src.fileno()).st_size
+            # sendfile writes to the file descriptor directly, so everything buffered must be written first
+            out_file.flush()
+            offset = 0
+            try:
+                while offset < file_size:
+                    sent = os.sendfile(out_file.fileno(), src.fileno(), offset, file_size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+                return offset
+            except OSError:
+                # Nothing written yet (e.g. the filesystem doesn't support sendfile): copy it the usual way
+                if offset:
+                    raise
+        
+        shutil.copyfileobj(src, out_file)
+        return src.tell()
+
+def create_ard_archive(input_dir: str, output_ard: str, output_arh: str, compress_files: bool = False,
+                       zlib_level: int = DEFAULT_ZLIB_LEVEL, zstd_level: int = DEFAULT_ARD_ZSTD_LEVEL,
+                       zstd_dict: bool = False) -> None:
+    """
+    Creates a new ARD archive from files in a directory (optimized version)
     
-    # Create the ARD file
-    print("Creating ARD file...")
+    Args:
+        input_dir: directory with files to archive
+        output_ard: path to create the ARD file
+        output_arh: path to create the ARH file
+        compress_files: if True, compress files in XBC1 format
+        zlib_level: compression level for small files (compressed with ZLIB)
+        zstd_level: compression level for files over 1 MB (compressed with ZSTD)
+        zstd_dict: if True (with compress_files), train a zstd dictionary on the small files,
+            compress them with ZSTD using it and store it in the ARH file
+            (only this tool can read such archives)
+    """
+    # Get the list of all files in the directory
+    # (the relative path is sliced off the full path instead of calling os.path.relpath for each file;
+    # the list itself is still needed for the file count and the dictionary samples)
+    log.info("Scanning directory...")
+    base_len = len(input_dir)
+    files = [(file_path, file_path[base_len:].lstrip(os.sep)) for file_path in iter_files(input_dir)]
+    
+    total_files = len(files)
+    print(f"Found {total_files} files to archive")
+    
+    # Train the dictionary once, the worker processes only receive its data
+    zstd_dict_data = None
+    if compress_files and zstd_dict:
+        log.info("Training zstd dictionary...")
+        zstd_dict_data = train_zstd_dictionary(files)
+        if zstd_dict_data:
+            log.info("Trained a %d byte zstd dictionary", len(zstd_dict_data))
+    
+    # Sort files by cache_id for more efficient searching. cache_ids don't depend on the file contents,
+    # so the order is known before processing and each file can be written as soon as it is ready
+    work = sorted(((get_ard_cache_id(file_path, rel_path), file_path, rel_path) for file_path, rel_path in files),
+                  key=lambda x: x[0])
+    
+    # Process the files and write them to the ARD file as they come
+    log.info("Processing files and creating ARD file...")
     entries = []
-    current_offset = 0
     
-    with open(output_ard, 'wb') as ard_file:
-        for cache_id, file_data, uncompressed_size in tqdm(processed_files, desc="Writing ARD"):
+    # Use ProcessPoolExecutor for parallel file processing: compression and hashing are CPU-bound,
+    # so separate processes scale across cores without contending for the GIL
+    # (workers receive only the paths and read the files themselves).
+    # Files are submitted in windows and at most two windows are in flight, so the workers compress
+    # the next window while the current one is written, and only those results are held in memory
+    process_file = functools.partial(process_ard_file, compress_files=compress_files,
+                                     zlib_level=zlib_level, zstd_level=zstd_level)
+    
+    # A large write buffer coalesces the small header, data and padding writes
+    # (max_workers is left to the executor: it defaults to the CPU count, capped at 61 on Windows)
+    with worker_logging() as (log_queue, log_level), \
+            concurrent.futures.ProcessPoolExecutor(initializer=init_create_worker,
+                                                   initargs=(zstd_dict_data, zstd_level, log_queue, log_level)) as executor, \
+            open(output_ard, 'wb', buffering=1024*1024) as ard_file:
+        results = map_in_windows(executor, process_file, work, window_size=1024, chunksize=16)
+        for result in tqdm(results, total=total_files, desc="Processing files"):
+            if result is None:
+                continue
+            
             # Write the file to ARD
-            ard_file.write(file_data)
+            cache_id, file_path, file_parts, uncompressed_size = result
+            if file_parts is None:
+                entry_start = ard_file.tell()
+                try:
+                    file_size = copy_file_into(ard_file, file_path)
+                except OSError as e:
+                    # Drop whatever part of the file was written, or every later offset would be shifted
+                    log.error("Error copying file %s: %s", file_path, e)
+                    ard_file.seek(entry_start)
+                    ard_file.truncate()
+                    continue
+            else:
+                file_size = 0
+                for part in file_parts:
+                    ard_file.write(part)
+                    file_size += len(part)
             
             # Calculate padding
-            padding_size = calculate_padding(len(file_data))
+            padding_size = calculate_padding(file_size)
             if padding_size > 0:
-                ard_file.write(b'\x00' * padding_size)
+                ard_file.write(ARD_PADDING[:padding_size])
             
-            # Save information for ARH
-            entries.append((cache_id, len(file_data), uncompressed_size))
-            
-            # Update the offset
-            current_offset += len(file_data) + padding_size
+            # Save information for ARH (offsets are not stored, readers recompute them from the sizes)
+            entries.append((cache_id, file_size, uncompressed_size))
     
     # Create the ARH file
-    print("Creating ARH file...")
+    log.info("Creating ARH file...")
     with open(output_arh, 'wb') as arh_file:
-        # Write the header
-        arh_file.write(b'arh2')  # Magic number
-        arh_file.write(struct.pack("<I", len(entries)))  # Number of entries
+        # Write the header, the entries start right after it
+        # (the last field is zero, or the offset of the zstd dictionary stored after the entries)
+        entries_offset = ARH_HEADER.size
+        dict_offset = entries_offset + len(entries) * ARH_ENTRY_DTYPE.itemsize if zstd_dict_data else 0
+        arh_file.write(ARH_HEADER.pack(b'arh2', len(entries), entries_offset, dict_offset))
         
-        # Offset to entries (after the header)
-        entries_offset = 16  # 4 (magic) + 4 (num_entries) + 4 (entries_offset) + 4 (padding)
-        entries_zero = 0
-        arh_file.write(struct.pack("<I", entries_offset))
-        arh_file.write(struct.pack("<I", entries_zero))
+        # Write all entries at once, in the same layout read_arh_entries reads them
+        np.array(entries, dtype=ARH_ENTRY_DTYPE).tofile(arh_file)
         
-        # Write the entries
-        for cache_id, size, uncomp_size in tqdm(entries, desc="Writing ARH"):
-            arh_file.write(struct.pack("<Q", cache_id))  # 8-byte cache_id
-            arh_file.write(struct.pack("<I", size))      # 4-byte size
-            arh_file.write(struct.pack("<I", uncomp_size))  # 4-byte uncompressed size
+        # Write the dictionary
+        if zstd_dict_data:
+            arh_file.write(ARH_DICT_HEADER.pack(ARH_DICT_TAG, len(zstd_dict_data)))
+            arh_file.write(zstd_dict_data)
     
     print("\nDone!")
     print(f"Created ARD archive: {output_ard}")
@@ -462,7 +986,6 @@ def create_ard_archive(input_dir: str, output_ard: str, output_arh: str, compres
 
 # Modify the main code to support packing
 if __name__ == "__main__":
-    import sys
     import argparse
     
     parser = argparse.ArgumentParser(description='XBC1 file archiver/extractor')
@@ -475,25 +998,41 @@ if __name__ == "__main__":
     parser.add_argument('-n', '--name', help='File name for XBC1 header (optional)')
     parser.add_argument('--ard', action='store_true', help='ARD extraction mode (requires ARH file)')
     parser.add_argument('--only-bdat', action='store_true', help='Only save BDAT files')
+    parser.add_argument('--pack-output', action='store_true',
+                        help='Save extracted files into a single .tar archive instead of a directory')
     parser.add_argument('--create-ard', action='store_true', help='Create a new ARD archive from a directory')
     parser.add_argument('--compress-files', action='store_true', help='Compress files when creating ARD archive')
+    parser.add_argument('--zstd-dict', action='store_true',
+                        help='With --compress-files, train a zstd dictionary for small files (archive is only readable by this tool)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print per-file details and progress messages')
+    parser.add_argument('--zlib-level', type=int, choices=range(0, 10), metavar='{0-9}',
+                        help=f'ZLIB compression level (default {DEFAULT_ZLIB_LEVEL}, 9 = maximum)')
+    parser.add_argument('--zstd-level', type=int, choices=range(1, 23), metavar='{1-22}',
+                        help=f'ZSTD compression level (default {DEFAULT_ZSTD_LEVEL}, or {DEFAULT_ARD_ZSTD_LEVEL} when creating '
+                             f'an ARD archive; 22 = maximum, for archival builds)')
     
     args = parser.parse_args()
     
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(message)s")
+    
     try:
         if args.create_ard:
             if not args.arh_file or not args.output_dir:
                 print("Error: to create an ARD archive, output ARD and ARH files must be specified")
                 print("Example: python script.py --create-ard input_dir output.ard output.arh")
                 sys.exit(1)
-            create_ard_archive(args.input_file, args.arh_file, args.output_dir, args.compress_files)
+            create_ard_archive(args.input_file, args.arh_file, args.output_dir, args.compress_files,
+                               DEFAULT_ZLIB_LEVEL if args.zlib_level is None else args.zlib_level,
+                               DEFAULT_ARD_ZSTD_LEVEL if args.zstd_level is None else args.zstd_level,
+                               args.zstd_dict)
         elif args.ard:
             if not args.arh_file:
                 print("Error: to extract ARD, an ARH file must be specified")
                 sys.exit(1)
-            extract_ard_with_arh(args.input_file, args.arh_file, args.output_dir, args.only_bdat)
+            extract_ard_with_arh(args.input_file, args.arh_file, args.output_dir, args.only_bdat, args.pack_output)
         elif args.compress:
-            compress_xbc1_file(args.input_file, args.output_dir, CompType(args.type), args.name)
+            level = args.zstd_level if args.type == CompType.ZSTD else args.zlib_level
+            compress_xbc1_file(args.input_file, args.output_dir, CompType(args.type), args.name, level)
         else:
             decompress_xbc1_file(args.input_file, args.output_dir)
     except Exception as e: